@@ -1,19 +1,40 @@
 import os
+import sys
 import time
+STARTUP_T0 = time.perf_counter()  # مبدأ زمان‌سنجی فازهای راه‌اندازی
 import asyncio
-import httpx
 import logging
 import json
+import heapq
+import bisect
+import uuid
+import base64
+import hashlib
 import urllib.parse
+import httpx
 from datetime import datetime
 from collections import deque
 from functools import wraps
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
-    filters, ContextTypes, CallbackQueryHandler
+    filters, ContextTypes, CallbackQueryHandler, TypeHandler
 )
 
+# --- زمان‌سنجی راه‌اندازی ---
+STARTUP_PHASES = []
+
+
+def mark_phase(name):
+    STARTUP_PHASES.append((name, time.perf_counter() - STARTUP_T0))
+
+
+def startup_report():
+    return ", ".join(f"{name}={elapsed * 1000:.0f}ms" for name, elapsed in STARTUP_PHASES)
+
+
+mark_phase("imports")
+
 # --- تنظیمات و دیتابیس ساده ---
 try:
     from bot_config import TOKEN, ADMIN_ID
@@ -22,22 +43,150 @@ except ImportError:
     ADMIN_ID = 0  # مقدار پیش‌فرض
 
 DB_FILE = "users_db.json"
+FILE_CACHE_FILE = "file_cache.json"
+FILE_CACHE_MAX = 1000
+HOST_PROFILES_FILE = "host_profiles.json"
+HOST_FAILURE_THRESHOLD = 3  # پس از این تعداد خطای پیاپی، میزبان موقتاً مسدود می‌شود (circuit breaker)
+HOST_COOLDOWN = 300  # مدت پایه مسدودی میزبان (ثانیه)؛ با تکرار خطا دو برابر می‌شود
+HOST_COOLDOWN_MAX = 3600  # سقف مسدودی، حتی اگر Retry-After سرور بیشتر باشد
+HOST_PROFILES_MAX = 500
+HOST_EWMA_ALPHA = 0.3
 LOG_FILE = "bot_log.txt"
-HISTORY_FILE = "download_history.txt"
+LOG_MAX_BYTES = 5 * 1024 * 1024  # پس از این حجم لاگ چرخانده و فشرده می‌شود
+LOG_BACKUPS = 5
+HISTORY_FILE = "download_history.jsonl"  # ژورنال append-only؛ هر خط یک رکورد JSON برای یک job
+HISTORY_REPORT_DAYS = 7
 DOWNLOAD_DIR = "downloads"
+WORKSPACE_STALE_AGE = 24 * 3600  # پوشه کاری بدون تغییر در این مدت (ثانیه) رهاشده حساب می‌شود
 CHUNK_SIZE = 47 * 1024 * 1024  # پارت‌های زیر 50 مگابایت
+RECV_BUFFER_MIN = 64 * 1024  # کمترین اندازه بافر دریافت قبل از نوشتن روی دیسک
+RECV_BUFFER_MAX = 8 * 1024 * 1024  # بافر از پیش رزرو شده هر job
+RECV_FLUSH_INTERVAL = 0.25  # اندازه بافر طوری تنظیم می‌شود که هر ~0.25 ثانیه یک بار پر شود
+PAUSE_KEEPALIVE = 60  # توقف‌های کوتاه‌تر از این (ثانیه) اتصال را باز نگه می‌دارند
 VIDEO_EXTS = ('.mp4', '.mkv', '.mov', '.avi', '.flv', '.webm', '.m4v')
 PAGE_SIZE = 8
+TIERS = ("admin", "premium", "free")  # به ترتیب اولویت در زمان‌بندی
+DEFAULT_SETTINGS = {
+    "global_limit": 100,
+    "daily_limit": 5,
+    "max_concurrent": 3,  # تعداد دانلودهای همزمان کل سرور
+    "tier_daily_mb": {"premium": 20480, "free": 2048},  # سقف حجم روزانه هر سطح (0 = نامحدود)
+}
+
+# --- لاگ غیرمسدود (QueueHandler/QueueListener) و ژورنال دانلودها ---
+history_log = logging.getLogger("history")
+
+
+def _gzip_rotator(source, dest):
+    import gzip
+    import shutil
+    with open(source, "rb") as sf, gzip.open(dest, "wb") as df:
+        shutil.copyfileobj(sf, df)
+    os.remove(source)
+
+
+def setup_logging():
+    # هندلرها فقط در thread شنونده اجرا می‌شوند؛ حلقه رویداد ربات فقط رکورد را در صف می‌گذارد
+    import queue
+    from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    file_handler.addFilter(lambda record: record.name != "history")
+
+    history_handler = logging.FileHandler(HISTORY_FILE, encoding="utf-8")
+    history_handler.setFormatter(logging.Formatter('%(message)s'))
+    history_handler.addFilter(lambda record: record.name == "history")
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, file_handler, history_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def journal_job(job, res, users):
+    finished = time.time()
+    if res == "completed":
+        size = job["size"]
+    else:
+        size = os.path.getsize(job["part_path"]) if os.path.exists(job["part_path"]) else 0
+    duration = job["active_time"]
+    history_log.info(json.dumps({
+        "ts": int(finished),
+        "date": str(datetime.now().date()),
+        "job": job["id"],
+        "url": job["url"],
+        "users": users,
+        "bytes": size,
+        "duration": round(duration, 2),
+        "speed": int(size / duration) if duration > 0 else 0,
+        "outcome": res if res in ("completed", "cancelled") else "error",
+        "error": None if res in ("completed", "cancelled") else res,
+        "sha256": job["sha256"],
+    }, ensure_ascii=False))
+
+
+def _read_lines_backwards(path, block=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos, tail = f.tell(), b""
+        while pos > 0:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                yield line
+        yield tail
+
+
+def history_report(days):
+    # گزارش روزانه و به تفکیک کاربر از روی ژورنال (در thread جدا اجرا می‌شود).
+    # ژورنال به ترتیب زمان append می‌شود؛ از انتها خوانده و به اولین رکورد قدیمی‌تر متوقف می‌شود
+    since = str(datetime.fromtimestamp(time.time() - days * 86400).date())
+    per_day, per_user = {}, {}
+    if not os.path.exists(HISTORY_FILE):
+        return per_day, per_user
+    for line in _read_lines_backwards(HISTORY_FILE):
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if rec["date"] < since:
+            break
+        day = per_day.setdefault(rec["date"], {"jobs": 0, "completed": 0, "bytes": 0, "completed_bytes": 0, "duration": 0.0})
+        day["jobs"] += 1
+        day["bytes"] += rec["bytes"]
+        # میانگین سرعت فقط از دانلودهای کامل؛ خطا و لغو (با حجم جزئی) آن را منحرف می‌کنند
+        if rec["outcome"] == "completed":
+            day["completed"] += 1
+            day["completed_bytes"] += rec["bytes"]
+            day["duration"] += rec["duration"]
+        for uid in rec["users"]:
+            user = per_user.setdefault(str(uid), {"jobs": 0, "bytes": 0})
+            user["jobs"] += 1
+            user["bytes"] += rec["bytes"]
+    return per_day, per_user
 
-# تنظیمات اولیه فایل‌ها
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 # --- مدیریت داده‌های کاربران ---
 def load_db():
     if os.path.exists(DB_FILE):
         with open(DB_FILE, "r") as f:
-            return json.load(f)
-    return {"users": {}, "settings": {"global_limit": 100, "daily_limit": 5}}
+            data = json.load(f)
+    else:
+        data = {"users": {}, "settings": {}}
+    # تنظیمات جدید برای دیتابیس‌های قدیمی مقدار پیش‌فرض می‌گیرند
+    for key, value in DEFAULT_SETTINGS.items():
+        data.setdefault("settings", {}).setdefault(key, value)
+    return data
 
 
 def save_db(db):
@@ -45,22 +194,275 @@ def save_db(db):
         json.dump(db, f, indent=4)
 
 
-db = load_db()
+db = None  # در load_data (در پس‌زمینه هنگام راه‌اندازی) بارگذاری می‌شود
 
 
-def check_user(user_id):
-    uid = str(user_id)
+# --- ایندکس‌ها و شمارنده‌های تجمعی (پنل ادمین بدون پیمایش کل کاربران) ---
+USER_INDEX = []  # شناسه‌های عددی کاربران به صورت مرتب، برای صفحه‌بندی keyset
+USAGE_INDEX = []  # (-downloads_today, uid) مرتب؛ فقط کاربرانی که در دوره جاری دانلود داشته‌اند
+STATS = {"day": "", "downloads": 0, "bytes": 0}  # جمع دوره جاری
+
+
+def current_period():
+    # دوره آماری = روز جاری + epoch بازنشانی. شمارنده کاربری که last_reset او با دوره
+    # جاری برابر نیست صفر حساب می‌شود و هنگام اولین استفاده (به صورت lazy) صفر می‌شود.
+    today = str(datetime.now().date())
+    if STATS["day"] != today:
+        STATS.update(day=today, downloads=0, bytes=0)
+        USAGE_INDEX.clear()
+    epoch = db["settings"].get("stats_epoch", 0)
+    return today if epoch == 0 else f"{today}#{epoch}"
+
+
+def user_counters(info):
+    if info.get("last_reset") != current_period():
+        return 0, 0
+    return info.get("downloads_today", 0), info.get("bytes_today", 0)
+
+
+def build_indexes():
+    period = current_period()
+    USER_INDEX[:] = sorted(int(uid) for uid in db["users"])
+    USAGE_INDEX[:] = sorted((-info["downloads_today"], int(uid)) for uid, info in db["users"].items()
+                            if info.get("last_reset") == period and info.get("downloads_today"))
+    STATS["downloads"] = -sum(count for count, _ in USAGE_INDEX)
+    STATS["bytes"] = sum(info.get("bytes_today", 0) for info in db["users"].values() if info.get("last_reset") == period)
+
+
+def new_user_record():
+    return {
+        "downloads_today": 0, "bytes_today": 0, "last_reset": current_period(),
+        "status": "active", "tier": "free", "personal_limit": None, "personal_daily_mb": None,
+    }
+
+
+def ensure_user(uid):
+    uid = str(uid)
     users = db.setdefault("users", {})
     if uid not in users:
-        users[uid] = {"downloads_today": 0, "last_reset": str(datetime.now().date()), "status": "active", "personal_limit": None}
+        users[uid] = new_user_record()
+        bisect.insort(USER_INDEX, int(uid))
+    return users[uid]
+
+
+def check_user(user_id):
+    uid = str(user_id)
+    if uid not in db.setdefault("users", {}):
+        ensure_user(uid)
         save_db(db)
 
-    today = str(datetime.now().date())
-    if users[uid]["last_reset"] != today:
-        users[uid]["downloads_today"] = 0
-        users[uid]["last_reset"] = today
+    period = current_period()
+    if db["users"][uid]["last_reset"] != period:
+        db["users"][uid]["downloads_today"] = 0
+        db["users"][uid]["bytes_today"] = 0
+        db["users"][uid]["last_reset"] = period
         save_db(db)
-    return users[uid]
+    return db["users"][uid]
+
+
+def record_download(user_id, size):
+    info = check_user(user_id)
+    key = (-info["downloads_today"], int(user_id))
+    pos = bisect.bisect_left(USAGE_INDEX, key)
+    if pos < len(USAGE_INDEX) and USAGE_INDEX[pos] == key:
+        del USAGE_INDEX[pos]
+    info["downloads_today"] += 1
+    info["bytes_today"] = info.get("bytes_today", 0) + size
+    bisect.insort(USAGE_INDEX, (-info["downloads_today"], int(user_id)))
+    STATS["downloads"] += 1
+    STATS["bytes"] += size
+    save_db(db)
+
+
+
+def user_tier(user_id):
+    if str(user_id) == str(ADMIN_ID):
+        return "admin"
+    return db["users"].get(str(user_id), {}).get("tier", "free")
+
+
+def daily_mb_limit(u_data, tier):
+    # اول سقف شخصی، سپس سقف سطح کاربر؛ 0 یا None یعنی نامحدود
+    if u_data.get("personal_daily_mb") is not None:
+        return u_data["personal_daily_mb"]
+    return db["settings"]["tier_daily_mb"].get(tier, 0)
+
+
+# --- کش file_id های تلگرام بر اساس هش محتوا ---
+# فایلی که قبلاً (حتی از لینک دیگری) آپلود شده، دوباره آپلود نمی‌شود
+def load_file_cache():
+    if os.path.exists(FILE_CACHE_FILE):
+        with open(FILE_CACHE_FILE, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_file_cache(cache):
+    with open(FILE_CACHE_FILE, "w") as f:
+        json.dump(cache, f)
+
+
+file_cache = None
+
+
+def remember_file_ids(sha256, file_ids):
+    file_cache.pop(sha256, None)
+    file_cache[sha256] = file_ids
+    while len(file_cache) > FILE_CACHE_MAX:
+        file_cache.pop(next(iter(file_cache)))
+    save_file_cache(file_cache)
+
+
+# --- پروفایل میزبان‌ها: یادگیری رفتار هر دامنه بین دانلودها ---
+def load_host_profiles():
+    if os.path.exists(HOST_PROFILES_FILE):
+        with open(HOST_PROFILES_FILE, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_host_profiles(profiles):
+    with open(HOST_PROFILES_FILE, "w") as f:
+        json.dump(profiles, f, indent=4)
+
+
+host_profiles = None
+
+
+def host_of(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+def get_host_profile(host):
+    # مثل file_cache: پروفایل استفاده‌شده به انتها منتقل و قدیمی‌ترین‌ها حذف می‌شوند
+    profile = host_profiles.pop(host, None)
+    if profile is not None:
+        host_profiles[host] = profile
+        return profile
+    while len(host_profiles) >= HOST_PROFILES_MAX:
+        host_profiles.pop(next(iter(host_profiles)))
+    return host_profiles.setdefault(host, {
+        "speed": 0,  # میانگین نمایی سرعت (بایت بر ثانیه)
+        "ttfb": 0,  # میانگین نمایی زمان رسیدن هدرها (ثانیه)
+        "ranges": None,  # پشتیبانی از Range؛ None یعنی هنوز نامشخص
+        "error_rate": 0.0,
+        "failures": 0,  # خطاهای پیاپی
+        "throttled": 0,  # تعداد پاسخ‌های 429/503
+        "open_until": 0,  # تا این زمان درخواستی به میزبان ارسال نمی‌شود
+        "jobs": 0,
+    })
+
+
+def _ewma(old, sample):
+    return sample if not old else old + HOST_EWMA_ALPHA * (sample - old)
+
+
+def host_blocked_for(profile):
+    return max(0, int(profile["open_until"] - time.time()))
+
+
+def host_timeout(profile):
+    # میزبان‌هایی که سریع پاسخ می‌دهند زودتر به عنوان قطع‌شده تشخیص داده می‌شوند
+    if not profile["ttfb"]:
+        return httpx.Timeout(60.0)
+    return httpx.Timeout(60.0, connect=min(30.0, max(5.0, profile["ttfb"] * 4)))
+
+
+def record_host_headers(profile, ttfb, resp):
+    profile["ttfb"] = _ewma(profile["ttfb"], ttfb)
+    if resp.status_code == 206 or resp.headers.get("Accept-Ranges", "").lower() == "bytes":
+        profile["ranges"] = True
+    elif resp.headers.get("Accept-Ranges", "").lower() == "none":
+        profile["ranges"] = False
+
+
+def record_host_success(profile, size, seconds):
+    profile["jobs"] += 1
+    profile["failures"] = 0
+    profile["open_until"] = 0
+    profile["error_rate"] *= 1 - HOST_EWMA_ALPHA
+    if seconds > 0 and size > 0:
+        profile["speed"] = int(_ewma(profile["speed"], size / seconds))
+    save_host_profiles(host_profiles)
+
+
+def record_host_failure(profile, resp=None):
+    profile["jobs"] += 1
+    profile["failures"] += 1
+    profile["error_rate"] += HOST_EWMA_ALPHA * (1.0 - profile["error_rate"])
+    retry_after = 0
+    if resp is not None and resp.status_code in (429, 503):
+        profile["throttled"] += 1
+        # فقط Retry-After صریح سرور میزبان را فوراً مسدود می‌کند؛ در غیر این صورت مثل بقیه خطاها شمرده می‌شود
+        value = resp.headers.get("Retry-After", "")
+        if value.isdigit():
+            retry_after = min(int(value), HOST_COOLDOWN_MAX)
+    if profile["failures"] >= HOST_FAILURE_THRESHOLD:
+        retry_after = max(retry_after, min(HOST_COOLDOWN_MAX, HOST_COOLDOWN * 2 ** (profile["failures"] - HOST_FAILURE_THRESHOLD)))
+    if retry_after:
+        profile["open_until"] = time.time() + retry_after
+    save_host_profiles(host_profiles)
+
+
+# --- راهنمای هش (از URL یا هدرهای سرور) ---
+def _sha256_hex(value):
+    value = value.strip().lower()
+    if len(value) == 64 and all(c in "0123456789abcdef" for c in value):
+        return value
+    return None
+
+
+def sha256_hint_from_url(url):
+    # مثال: ...?sha256=<hex> یا ...#checksum=sha256:<hex>
+    # مقدار hex بدون پیشوند فقط برای کلید sha256 پذیرفته می‌شود؛ hash= در لینک‌های امضاشده
+    # CDN ها معمولاً توکن HMAC است و نه هش محتوا
+    parsed = urllib.parse.urlsplit(url)
+    params = urllib.parse.parse_qs(parsed.query)
+    params.update(urllib.parse.parse_qs(parsed.fragment))
+    for key in ("sha256", "checksum", "hash"):
+        for value in params.get(key, []):
+            if value.lower().startswith(("sha256:", "sha-256:")):
+                value = value.split(":", 1)[1]
+            elif key != "sha256":
+                continue
+            hint = _sha256_hex(value)
+            if hint:
+                return hint
+    return None
+
+
+def sha256_hint_from_headers(headers):
+    hint = _sha256_hex(headers.get("X-Checksum-Sha256", ""))
+    if hint:
+        return hint
+
+    # Repr-Digest: sha-256=:<base64>:  و  Digest: SHA-256=<base64>
+    for name in ("Repr-Digest", "Digest"):
+        for item in headers.get(name, "").split(","):
+            algo, _, value = item.strip().partition("=")
+            if algo.lower() != "sha-256" or not value:
+                continue
+            try:
+                digest = base64.b64decode(value.strip(":"), validate=True)
+            except Exception:
+                digest = b""
+            if len(digest) == 32:
+                return digest.hex()
+            logging.warning(f"Invalid {name} header: {item}")
+    return None
+
+
+def hash_file_prefix(path, size):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = size
+        while remaining > 0:
+            data = f.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher
 
 
 # --- توابع کمکی رابط کاربری ---
@@ -104,6 +506,14 @@ async def safe_remove(path):
     return await run_in_background(_rm)
 
 
+async def safe_rmtree(path):
+    def _rmtree():
+        import shutil
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+    return await run_in_background(_rmtree)
+
+
 # --- دکوراتور admin-only ---
 
 def admin_only(func):
@@ -136,73 +546,578 @@ def register_admin_callback(key):
     return deco
 
 
+# --- رجیستری دانلودهای در جریان (single-flight) ---
+# هر URL در هر لحظه فقط یک بار دانلود می‌شود؛ درخواست‌های بعدی همان لینک
+# مشترک (subscriber) همان job می‌شوند و پیشرفت و فایل نهایی را با هم دریافت می‌کنند.
+ACTIVE_JOBS = {}
+
+
+# --- زمان‌بندی بر اساس اولویت (admin > premium > free) ---
+# فقط job های در حال دانلود slot دارند. job جدید در صورت پر بودن ظرفیت یا یک job
+# کم‌اولویت‌تر را موقتاً کنار می‌زند (preempt) یا در صف اولویت منتظر می‌ماند.
+SCHEDULER = {"running": {}, "waiting": [], "seq": 0}
+
+
+def job_rank(job):
+    return min((TIERS.index(user_tier(s["user_id"])) for s in job["subscribers"]), default=len(TIERS) - 1)
+
+
+def _enqueue(job):
+    SCHEDULER["seq"] += 1
+    job["queue_seq"] = SCHEDULER["seq"]
+    job["status"] = "queued"
+    job["run_event"].clear()
+    # job کنارزده‌شده جایگاه ورود اولیه‌اش را در صف حفظ می‌کند
+    heapq.heappush(SCHEDULER["waiting"], (job["rank"], job["arrival"], job["queue_seq"], job))
+
+
+def _grant(job):
+    SCHEDULER["running"][job["id"]] = job
+    job["status"] = "downloading"
+    job["run_event"].set()
+
+
+def request_slot(job):
+    job["rank"] = job_rank(job)
+    if job["arrival"] is None:
+        SCHEDULER["seq"] += 1
+        job["arrival"] = SCHEDULER["seq"]
+    if job["id"] in SCHEDULER["running"]:
+        return
+
+    running = SCHEDULER["running"]
+    if len(running) >= db["settings"]["max_concurrent"]:
+        victims = [j for j in running.values() if j["rank"] > job["rank"]]
+        if not victims:
+            _enqueue(job)
+            asyncio.create_task(notify_subscribers(job, "⏳ ظرفیت دانلود پر است؛ لینک شما در صف اولویت قرار گرفت."))
+            return
+        victim = max(victims, key=lambda j: j["rank"])
+        running.pop(victim["id"])
+        _enqueue(victim)
+        asyncio.create_task(notify_subscribers(victim, "⏸ دانلود به دلیل اولویت کاربران دیگر موقتاً متوقف شد و به‌زودی ادامه می‌یابد."))
+    _grant(job)
+
+
+def release_slot(job):
+    SCHEDULER["running"].pop(job["id"], None)
+    fill_slots()
+
+
+def fill_slots():
+    waiting = SCHEDULER["waiting"]
+    while waiting and len(SCHEDULER["running"]) < db["settings"]["max_concurrent"]:
+        _, _, seq, job = heapq.heappop(waiting)
+        # ورودی‌های قدیمی (job متوقف/لغو شده یا اولویت‌دهی مجدد) نادیده گرفته می‌شوند
+        if job["status"] == "queued" and job["queue_seq"] == seq:
+            _grant(job)
+
+
+async def notify_subscribers(job, text):
+    for sub in list(job["subscribers"]):
+        try:
+            await job["bot"].edit_message_text(text, sub["chat_id"], sub["msg_id"])
+        except Exception:
+            pass
+
+
+def get_or_create_job(url, filename, bot):
+    job = ACTIVE_JOBS.get(url)
+    # job لغوشده‌ای که هنوز در حال بسته شدن است قابل اشتراک نیست
+    if job is None or job["status"] == "cancelled":
+        # هر job پوشه کاری مخصوص خودش را دارد تا فایل‌های هم‌نام با هم تداخل نکنند
+        job_id = uuid.uuid4().hex[:12]
+        filename = os.path.basename(filename.replace('\\', '/')) or f"file_{int(time.time())}"
+        workdir = os.path.join(DOWNLOAD_DIR, job_id)
+        os.makedirs(workdir, exist_ok=True)
+        job = {
+            "id": job_id,
+            "url": url,
+            "filename": filename,
+            "workdir": workdir,
+            "part_path": os.path.join(workdir, filename + ".part"),
+            "file_path": os.path.join(workdir, filename),
+            "validator": None,  # ETag یا Last-Modified برای ادامه امن با If-Range
+            "hasher": None,  # sha256 افزایشی که همراه با نوشتن هر chunk به‌روز می‌شود
+            "expected_sha256": sha256_hint_from_url(url),
+            "sha256": None,
+            "status": "new",  # new / queued / downloading / paused / done / cancelled
+            "run_event": asyncio.Event(),  # فقط وقتی job اجازه دانلود دارد (یا لغو شده) set است
+            "rank": len(TIERS) - 1,
+            "arrival": None,
+            "queue_seq": 0,
+            "size": 0,
+            "total": 0,  # حجم اعلام‌شده سرور؛ برای رزرو سهمیه حجم مشترک‌ها
+            "active_time": 0.0,  # فقط زمان واقعی دانلود؛ انتظار در صف و توقف‌ها حساب نمی‌شوند
+            "subscribers": [],
+            "users": set(),  # همه کاربرانی که زمانی مشترک بوده‌اند (برای ژورنال، حتی پس از لغو)
+            "file_ids": None,  # پس از اولین آپلود، بقیه مشترک‌ها با file_id دریافت می‌کنند
+            "bot": bot,
+            "task": None,
+        }
+        ACTIVE_JOBS[url] = job
+        # هر job دقیقاً یک task دارد؛ توقف و ادامه فقط run_event را تغییر می‌دهند
+        job["task"] = asyncio.create_task(run_job(job))
+    return job
+
+
+def pause_job(job):
+    if job["status"] not in ("downloading", "queued"):
+        return False
+    job["status"] = "paused"
+    job["run_event"].clear()
+    release_slot(job)
+    return True
+
+
+def resume_job(job):
+    if job["status"] != "paused":
+        return False
+    request_slot(job)
+    return True
+
+
+def subscribe(job, chat_id, msg_id, user_id):
+    sub = {
+        "chat_id": chat_id,
+        "msg_id": msg_id,
+        "user_id": user_id,
+        "done": asyncio.get_running_loop().create_future(),
+    }
+    job["subscribers"].append(sub)
+    job["users"].add(user_id)
+    # پیوستن کاربر پراولویت‌تر به job در حال دانلود هم اولویت آن را بالا می‌برد تا کنار زده نشود
+    job["rank"] = job_rank(job)
+    return sub
+
+
+def unsubscribe(job, sub, res):
+    if sub in job["subscribers"]:
+        job["subscribers"].remove(sub)
+    if not sub["done"].done():
+        sub["done"].set_result(res)
+
+    # اگر کسی منتظر این job نیست، دانلود را متوقف کن
+    if not job["subscribers"]:
+        job["status"] = "cancelled"
+        job["run_event"].set()
+        release_slot(job)
+    elif job["status"] == "paused":
+        # مشترک‌های باقی‌مانده دکمه ادامه ندارند؛ توقف کسی که رفته نباید آن‌ها را معطل کند
+        resume_job(job)
+
+
+def enforce_byte_quota(job, size):
+    # حجم این فایل به‌علاوه فایل‌های در حال دانلود دیگر کاربر نباید از سهمیه باقی‌مانده‌اش بیشتر شود
+    for sub in list(job["subscribers"]):
+        user_id = sub["user_id"]
+        info = db["users"].get(str(user_id), {})
+        mb_limit = daily_mb_limit(info, user_tier(user_id))
+        if not mb_limit or user_id == ADMIN_ID or sub["done"].done():
+            continue
+        reserved = sum(other["total"] for other in ACTIVE_JOBS.values() if other is not job and any(
+            s["user_id"] == user_id and not s["done"].done() for s in other["subscribers"]))
+        if user_counters(info)[1] + reserved + size > mb_limit * 1024 * 1024:
+            unsubscribe(job, sub, f"⚠️ سقف حجم دانلود روزانه شما ({mb_limit} مگابایت) تمام شده است.")
+
+
+async def drop_job(job):
+    if ACTIVE_JOBS.get(job["url"]) is job:
+        ACTIVE_JOBS.pop(job["url"], None)
+    await safe_rmtree(job["workdir"])
+
+
+async def run_job(job):
+    while True:
+        # منتظر slot زمان‌بند (یا ادامه پس از توقف طولانی)؛ سپس اتصال با Range معتبرسازی‌شده باز می‌شود
+        await job["run_event"].wait()
+        if job["status"] == "cancelled":
+            res = "cancelled"
+            break
+        engine_t = time.monotonic()
+        res = await download_engine(job)
+        job["active_time"] += time.monotonic() - engine_t
+        if res not in ("paused", "reopen"):
+            break
+
+    journal_job(job, res, sorted(job["users"]))
+
+    # ارسال به تلگرام slot دانلود را اشغال نمی‌کند؛ ورودی‌های باقی‌مانده این job در صف هم باطل می‌شوند
+    if job["status"] != "cancelled":
+        job["status"] = "done"
+    release_slot(job)
+
+    if res == "completed":
+        # مشترک‌هایی که حین ارسال اضافه می‌شوند هم در همین حلقه پوشش داده می‌شوند
+        while True:
+            pending = [s for s in job["subscribers"] if not s["done"].done()]
+            if not pending:
+                break
+            for sub in pending:
+                try:
+                    await deliver_file(job, sub)
+                    sub_res = res
+                except Exception as e:
+                    logging.exception("Upload error")
+                    sub_res = str(e)
+                if not sub["done"].done():
+                    sub["done"].set_result(sub_res)
+    else:
+        for sub in list(job["subscribers"]):
+            if not sub["done"].done():
+                sub["done"].set_result(res)
+
+    await drop_job(job)
+
+
 # --- هسته دانلود و پارت‌بندی ---
-async def download_engine(chat_id, context, url, filename):
-    chat_data = context.chat_data
-    file_path = os.path.join(DOWNLOAD_DIR, filename)
-    downloaded = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+async def download_engine(job):
+    url = job["url"]
+    part_path = job["part_path"]
+    downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    warm_resumed = False
+
+    # بدون ETag/Last-Modified نمی‌توان مطمئن شد فایل سرور تغییر نکرده؛ از ابتدا دانلود کن
+    headers = {}
+    if downloaded > 0 and job["validator"]:
+        headers = {"Range": f"bytes={downloaded}-", "If-Range": job["validator"]}
+    else:
+        downloaded = 0
 
-    async with httpx.AsyncClient(timeout=60.0, follow_redirects=True) as client:
+    # میزبانی که پشت سر هم خطا داده یا محدودمان کرده، تا پایان مهلت امتحان نمی‌شود
+    profile = get_host_profile(host_of(url))
+    blocked = host_blocked_for(profile)
+    if blocked:
+        logging.warning(f"Circuit open for {host_of(url)} ({blocked}s left), skipping {url}")
+        return f"میزبان موقتاً در دسترس نیست؛ {blocked} ثانیه دیگر دوباره تلاش کنید"
+
+    async with httpx.AsyncClient(timeout=host_timeout(profile), follow_redirects=True) as client:
         try:
-            async with client.stream("GET", url, headers={"Range": f"bytes={downloaded}-"}) as resp:
+            request_t = time.monotonic()
+            async with client.stream("GET", url, headers=headers) as resp:
                 if resp.status_code not in (200, 206):
                     logging.error(f"Bad status code: {resp.status_code} for {url}")
+                    # فقط خطای سرور و محدودیت نرخ نشانه مشکل میزبان است؛ 403/404/410 مربوط به همین لینک است
+                    if resp.status_code == 429 or resp.status_code >= 500:
+                        record_host_failure(profile, resp)
                     return "error"
+                record_host_headers(profile, time.monotonic() - request_t, resp)
+
+                # اگر سرور Range را نپذیرفت (یا If-Range نامعتبر بود) کل فایل را می‌فرستد
+                if resp.status_code == 206:
+                    content_range = resp.headers.get("Content-Range", "")
+                    if not content_range.startswith(f"bytes {downloaded}-"):
+                        logging.error(f"Unexpected Content-Range '{content_range}' for {url}")
+                        return "error"
+                elif downloaded > 0:
+                    logging.info(f"Origin changed or ignored Range, restarting {url}")
+                    downloaded = 0
+
+                etag = resp.headers.get("ETag")
+                if etag and not etag.startswith("W/"):
+                    job["validator"] = etag
+                else:
+                    job["validator"] = resp.headers.get("Last-Modified")
+
+                job["expected_sha256"] = job["expected_sha256"] or sha256_hint_from_headers(resp.headers)
 
                 total_header = resp.headers.get("Content-Length")
                 total = int(total_header) + downloaded if total_header and total_header.isdigit() else 0
+                job["total"] = total
+                enforce_byte_quota(job, total)
+                if job["status"] == "cancelled":
+                    return "cancelled"
                 mode = "ab" if downloaded > 0 else "wb"
 
+                # ادامه هش از همان نقطه؛ فقط اگر وضعیت هش از دست رفته باشد ابتدای فایل دوباره خوانده می‌شود
+                hasher = job["hasher"]
+                if downloaded == 0:
+                    hasher = hashlib.sha256()
+                elif hasher is None:
+                    hasher = await run_in_background(hash_file_prefix, part_path, downloaded)
+                job["hasher"] = hasher
+
                 # track initial downloaded to compute speed properly
-                start_t = time.time()
+                start_t = time.monotonic()
                 start_downloaded = downloaded
                 last_upd = 0
 
-                with open(file_path, mode) as f:
+                # chunk ها در یک بافر از پیش رزرو شده جمع می‌شوند و یکجا نوشته و هش می‌شوند؛
+                # زمان، تنظیم اندازه بافر و گزارش پیشرفت فقط در این نقاط انجام می‌شود.
+                # وضعیت توقف/لغو (یک lookup ساده) برای هر chunk بررسی می‌شود تا job متوقف‌شده
+                # با سرعت پایین چند مگابایت دیگر ادامه ندهد (slot آن قبلاً آزاد شده است).
+                if job.get("buffer") is None:
+                    job["buffer"] = bytearray(RECV_BUFFER_MAX)
+                view = memoryview(job["buffer"])
+                filled = 0
+                # شروع با اندازه بافر مناسب سرعت شناخته‌شده میزبان
+                learned = int(profile["speed"] * RECV_FLUSH_INTERVAL) & ~0xFFFF
+                flush_size = job.get("flush_size", min(RECV_BUFFER_MAX, max(RECV_BUFFER_MIN, learned)))
+                checkpoint = downloaded + flush_size
+                last_check_t = start_t
+                last_check_bytes = downloaded
+                warm_resumed = False
+
+                with open(part_path, mode) as f:
                     async for chunk in resp.aiter_bytes():
-                        if chat_data.get('status') == 'paused':
-                            return "paused"
-                        if chat_data.get('status') == 'cancelled':
-                            return "cancelled"
-
-                        f.write(chunk)
-                        downloaded += len(chunk)
-
-                        # گزارش وضعیت هر 3 ثانیه
-                        if time.time() - last_upd > 3:
-                            elapsed = time.time() - start_t + 0.1
-                            speed = (downloaded - start_downloaded) / elapsed
-                            percent = (downloaded / total * 100) if total > 0 else 0
-                            eta = int((total - downloaded) / (speed + 1)) if total > 0 else -1
-
-                            if total > 0:
-                                size_txt = f"{human_readable_size(downloaded)} / {human_readable_size(total)}"
-                                eta_txt = f"{eta} ثانیه"
-                            else:
-                                size_txt = human_readable_size(downloaded)
-                                eta_txt = "نامشخص"
-
-                            text = (
-                                f"📥 **در حال دریافت فایل...**\\n\\n"
-                                f"📄 `{filename}`\\n"
-                                f"📊 {get_progress_bar(percent)} {percent:.1f}%\\n"
-                                f"⚡️ سرعت: {human_readable_size(speed)}/s\\n"
-                                f"📦 حجم: {size_txt}\\n"
-                                f"⏳ زمان: {eta_txt}"
-                            )
-                            kb = [[InlineKeyboardButton("⏸ توقف", callback_data="dl_pause"),
-                                   InlineKeyboardButton("❌ لغو", callback_data="dl_cancel")]]
+                        n = len(chunk)
+                        if filled + n > flush_size and filled:
+                            f.write(view[:filled])
+                            hasher.update(view[:filled])
+                            filled = 0
+                        if n >= flush_size:
+                            f.write(chunk)
+                            hasher.update(chunk)
+                        else:
+                            view[filled:filled + n] = chunk
+                            filled += n
+                        downloaded += n
+
+                        if job['status'] != 'downloading':
+                            f.write(view[:filled])
+                            hasher.update(view[:filled])
+                            filled = 0
+                            f.flush()
+
+                            # توقف کوتاه: اتصال و بافرها زنده می‌مانند و همین stream ادامه پیدا می‌کند
+                            paused_t = time.monotonic()
                             try:
-                                await context.bot.edit_message_text(text, chat_id, chat_data['msg_id'], reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
-                            except Exception:
-                                pass
-                            last_upd = time.time()
+                                # میزبان بدون Range را نمی‌توان ادامه داد؛ اتصالش بیشتر نگه داشته می‌شود
+                                keepalive = PAUSE_KEEPALIVE if profile["ranges"] else PAUSE_KEEPALIVE * 10
+                                await asyncio.wait_for(job["run_event"].wait(), keepalive)
+                            except asyncio.TimeoutError:
+                                job["active_time"] -= time.monotonic() - paused_t
+                                return "paused"
+                            paused_for = time.monotonic() - paused_t
+                            job["active_time"] -= paused_for
+                            if job['status'] == 'cancelled':
+                                return "cancelled"
+                            warm_resumed = True
+                            start_t += paused_for
+                            last_check_t += paused_for
+
+                        if downloaded < checkpoint:
+                            continue
+
+                        # اندازه بافر را با سرعت اندازه‌گیری‌شده هماهنگ کن
+                        now = time.monotonic()
+                        rate = (downloaded - last_check_bytes) / max(now - last_check_t, 1e-3)
+                        flush_size = min(RECV_BUFFER_MAX, max(RECV_BUFFER_MIN, int(rate * RECV_FLUSH_INTERVAL) & ~0xFFFF))
+                        job["flush_size"] = flush_size
+                        checkpoint = downloaded + flush_size
+                        last_check_t = now
+                        last_check_bytes = downloaded
+                        # بدون Content-Length سهمیه با حجم دریافت‌شده تا اینجا سنجیده می‌شود
+                        if not total:
+                            enforce_byte_quota(job, downloaded)
+
+                        # گزارش وضعیت هر 3 ثانیه (بدون منتظر ماندن برای ویرایش پیام‌ها)
+                        if now - last_upd > 3:
+                            speed = (downloaded - start_downloaded) / (now - start_t + 0.1)
+                            if job.get("progress_task") is None or job["progress_task"].done():
+                                job["progress_task"] = asyncio.create_task(report_progress(job, downloaded, total, speed))
+                            last_upd = now
+
+                    f.write(view[:filled])
+                    hasher.update(view[:filled])
+
+                # اتصالی که حین توقف از سمت سرور بسته شده ممکن است بی‌صدا کوتاه تمام شود
+                if total > 0 and downloaded != total:
+                    logging.warning(f"Stream ended at {downloaded}/{total} for {url}")
+                    if warm_resumed:
+                        return "reopen"
+                    record_host_failure(profile)
+                    return "error"
+
+                record_host_success(profile, downloaded - start_downloaded, time.monotonic() - start_t)
+
+            job["sha256"] = hasher.hexdigest()
+            if job["expected_sha256"] and job["expected_sha256"] != job["sha256"]:
+                logging.error(f"SHA-256 mismatch for {url}: expected {job['expected_sha256']}, got {job['sha256']}")
+                return "هش SHA-256 فایل با مقدار اعلام‌شده مطابقت ندارد"
+
+            # جابجایی اتمیک فایل کامل‌شده از .part به نام نهایی
+            os.replace(part_path, job["file_path"])
+            job["size"] = downloaded
             return "completed"
+        except httpx.TransportError as e:
+            if warm_resumed:
+                logging.info(f"Kept-alive stream dropped after resume, reopening {url}: {e}")
+                return "reopen"
+            logging.exception("Download engine error")
+            record_host_failure(profile)
+            return str(e)
         except Exception as e:
+            # خطاهای محلی (دیسک پر، os.replace، خواندن .part) ربطی به میزبان ندارند
             logging.exception("Download engine error")
             return str(e)
 
 
+async def report_progress(job, downloaded, total, speed):
+    percent = (downloaded / total * 100) if total > 0 else 0
+    eta = int((total - downloaded) / (speed + 1)) if total > 0 else -1
+
+    if total > 0:
+        size_txt = f"{human_readable_size(downloaded)} / {human_readable_size(total)}"
+        eta_txt = f"{eta} ثانیه"
+    else:
+        size_txt = human_readable_size(downloaded)
+        eta_txt = "نامشخص"
+
+    text = (
+        f"📥 **در حال دریافت فایل...**\\n\\n"
+        f"📄 `{job['filename']}`\\n"
+        f"📊 {get_progress_bar(percent)} {percent:.1f}%\\n"
+        f"⚡️ سرعت: {human_readable_size(speed)}/s\\n"
+        f"📦 حجم: {size_txt}\\n"
+        f"⏳ زمان: {eta_txt}"
+    )
+    if len(job["subscribers"]) > 1:
+        text += f"\\n👥 مشترک بین {len(job['subscribers'])} کاربر"
+    kb = [[InlineKeyboardButton("⏸ توقف", callback_data="dl_pause"),
+           InlineKeyboardButton("❌ لغو", callback_data="dl_cancel")]]
+    for sub in list(job["subscribers"]):
+        if job["status"] != "downloading":
+            return
+        try:
+            await job["bot"].edit_message_text(text, sub["chat_id"], sub["msg_id"], reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        except Exception:
+            pass
+
+
+def sent_file_id(message):
+    if message.video:
+        return "video", message.video.file_id
+    return "document", message.document.file_id
+
+
+async def deliver_file(job, sub):
+    bot = job["bot"]
+    chat_id = sub["chat_id"]
+    filename = job["filename"]
+    file_path = job["file_path"]
+
+    try:
+        await bot.edit_message_text("✅ دانلود تمام شد. در حال ارسال به تلگرام...", chat_id, sub["msg_id"])
+    except Exception:
+        pass
+
+    # همین محتوا قبلاً آپلود شده است (با همین لینک یا لینکی دیگر)
+    if job["file_ids"] is None and job["sha256"] in file_cache:
+        job["file_ids"] = [tuple(item) for item in file_cache[job["sha256"]]]
+        if len(job["file_ids"]) == 1:
+            kind, file_id, _, _ = job["file_ids"][0]
+            job["file_ids"] = [(kind, file_id, filename, None)]
+
+    # فایل قبلاً برای مشترک دیگری آپلود شده؛ فقط file_id ها را بفرست
+    if job["file_ids"] is not None:
+        for kind, file_id, caption, parse_mode in job["file_ids"]:
+            if kind == "video":
+                await bot.send_video(chat_id, video=file_id, caption=caption, supports_streaming=True, parse_mode=parse_mode)
+            else:
+                await bot.send_document(chat_id, document=file_id, caption=caption, parse_mode=parse_mode)
+        return
+
+    if not os.path.exists(file_path):
+        return
+
+    is_vid = filename.lower().endswith(VIDEO_EXTS)
+    file_size = os.path.getsize(file_path)
+    sent = []
+    skipped = False  # پارتی که ارسال نشد؛ مجموعه ناقص نباید کش شود
+
+    # --- شروع بخش برش نهایی و قطعی ---
+    if file_size > CHUNK_SIZE:
+        await bot.edit_message_text("✂️ در حال قطعه‌قطعه کردن ویدیو (این کار ممکن است کمی طول بکشد)...", chat_id, sub["msg_id"])
+
+        base_name, extension = os.path.splitext(filename)
+        if not extension:
+            extension = ".mp4"
+        clean_name = "".join([c for c in base_name if c.isalnum()]).strip()
+
+        # ایجاد پوشه موقت
+        temp_parts_dir = os.path.join(job["workdir"], f"parts_{chat_id}")
+        os.makedirs(temp_parts_dir, exist_ok=True)
+
+        try:
+            output_template = os.path.join(temp_parts_dir, f"Part_%03d_{clean_name}{extension}")
+
+            command = [
+                'ffmpeg', '-y', '-i', file_path,
+                '-force_key_frames', 'expr:gte(t,n_forced*60)',
+                '-f', 'segment',
+                '-segment_time', '00:07:00',
+                '-reset_timestamps', '1',
+                '-map', '0',
+                '-c', 'copy',
+                output_template
+            ]
+
+            # اجرای ffmpeg به صورت غیرمسدود
+            await run_ffmpeg_async(command)
+
+            generated_parts = sorted([f for f in os.listdir(temp_parts_dir) if f.startswith("Part_")])
+
+            if not generated_parts:
+                raise Exception("No parts created")
+
+            total = len(generated_parts)
+            for i, p_file in enumerate(generated_parts, 1):
+                p_path = os.path.join(temp_parts_dir, p_file)
+                if sub not in job["subscribers"]:
+                    sent = None
+                    break
+
+                if os.path.getsize(p_path) > 48 * 1024 * 1024:
+                    logging.warning(f"Part too large even after segmentation: {p_path}")
+                    skipped = True
+                    continue
+
+                with open(p_path, 'rb') as tp:
+                    caption = f"🎬 **{filename}**\\n📦 پارت {i} از {total}"
+                    m = await bot.send_video(
+                        chat_id, video=tp, caption=caption,
+                        supports_streaming=True, parse_mode='Markdown',
+                        read_timeout=300, write_timeout=300
+                    )
+                    sent.append((*sent_file_id(m), caption, 'Markdown'))
+
+                await safe_remove(p_path)
+                await asyncio.sleep(2)
+
+        except Exception as e:
+            sent = None
+            logging.exception("Final Attempt Error")
+            await bot.send_message(chat_id, "❌ متاسفانه به دلیل ساختار خاص این ویدیو، امکان برش هوشمند نبود.")
+
+        finally:
+            await safe_rmtree(temp_parts_dir)
+    # --- پایان بخش برش ---
+
+    # --- شروع بخش ارسال تک فایل ---
+    else:
+        with open(file_path, 'rb') as f:
+            if is_vid:
+                m = await bot.send_video(
+                    chat_id, video=f,
+                    caption=filename,
+                    supports_streaming=True,
+                    read_timeout=120, write_timeout=120
+                )
+            else:
+                m = await bot.send_document(
+                    chat_id, document=f,
+                    caption=filename,
+                    read_timeout=120, write_timeout=120
+                )
+            sent.append((*sent_file_id(m), filename, None))
+
+    # فقط مجموعه کامل پارت‌ها برای مشترک‌های بعدی و کش استفاده می‌شود
+    if sent and not skipped:
+        job["file_ids"] = sent
+        remember_file_ids(job["sha256"], sent)
+
+
 # --- helpers for admin UI ---
 
 def get_admin_markup():
@@ -251,21 +1166,63 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             return await update.message.reply_text("❌ لطفاً فقط یک عدد انگلیسی ارسال کنید.")
 
+    # admin searches for a user by id
+    if user_id == ADMIN_ID and context.user_data.get('waiting_for_user_search'):
+        context.user_data['waiting_for_user_search'] = False
+        target_uid = update.message.text.strip()
+        if target_uid not in db['users']:
+            return await update.message.reply_text(f"❌ کاربری با شناسه {target_uid} یافت نشد.")
+        msg, markup = user_panel(target_uid, 0)
+        return await update.message.reply_text(msg, reply_markup=markup)
+
     # admin sets personal limit for a user
     if user_id == ADMIN_ID and context.user_data.get('setting_user_limit_for'):
         target_uid = context.user_data.get('setting_user_limit_for')
         if update.message.text.isdigit():
             new_limit = int(update.message.text)
-            if target_uid in db['users']:
-                db['users'][target_uid]['personal_limit'] = new_limit
-            else:
-                db['users'][target_uid] = {"downloads_today": 0, "last_reset": str(datetime.now().date()), "status": "active", "personal_limit": new_limit}
+            ensure_user(target_uid)['personal_limit'] = new_limit
             save_db(db)
             context.user_data.pop('setting_user_limit_for', None)
             return await update.message.reply_text(f"✅ محدودیت {new_limit} برای کاربر {target_uid} تنظیم شد.")
         else:
             return await update.message.reply_text("❌ لطفاً فقط یک عدد انگلیسی ارسال کنید.")
 
+    # admin sets personal daily byte quota (MB) for a user
+    if user_id == ADMIN_ID and context.user_data.get('setting_user_mb_for'):
+        target_uid = context.user_data.get('setting_user_mb_for')
+        if update.message.text.isdigit():
+            new_limit = int(update.message.text)
+            ensure_user(target_uid)['personal_daily_mb'] = new_limit
+            save_db(db)
+            context.user_data.pop('setting_user_mb_for', None)
+            return await update.message.reply_text(f"✅ سقف حجم روزانه {new_limit} مگابایت برای کاربر {target_uid} تنظیم شد.")
+        else:
+            return await update.message.reply_text("❌ لطفاً فقط یک عدد انگلیسی ارسال کنید.")
+
+    # admin sets daily byte quota (MB) for a tier
+    if user_id == ADMIN_ID and context.user_data.get('setting_tier_mb_for'):
+        tier = context.user_data.get('setting_tier_mb_for')
+        if update.message.text.isdigit():
+            new_limit = int(update.message.text)
+            db['settings']['tier_daily_mb'][tier] = new_limit
+            save_db(db)
+            context.user_data.pop('setting_tier_mb_for', None)
+            return await update.message.reply_text(f"✅ سقف حجم روزانه سطح {tier} به {new_limit} مگابایت تغییر یافت.")
+        else:
+            return await update.message.reply_text("❌ لطفاً فقط یک عدد انگلیسی ارسال کنید.")
+
+    # admin sets max concurrent downloads
+    if user_id == ADMIN_ID and context.user_data.get('waiting_for_concurrency'):
+        if update.message.text.isdigit() and int(update.message.text) > 0:
+            new_limit = int(update.message.text)
+            db['settings']['max_concurrent'] = new_limit
+            save_db(db)
+            context.user_data['waiting_for_concurrency'] = False
+            fill_slots()
+            return await update.message.reply_text(f"✅ ظرفیت دانلود همزمان به {new_limit} تغییر یافت.")
+        else:
+            return await update.message.reply_text("❌ لطفاً فقط یک عدد انگلیسی بزرگ‌تر از صفر ارسال کنید.")
+
     u_data = check_user(user_id)
 
     if u_data["status"] == "banned":
@@ -278,6 +1235,10 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if u_data["downloads_today"] >= limit and user_id != ADMIN_ID:
             return await update.message.reply_text(f"⚠️ سقف دانلود روزانه شما ({limit}) تمام شده است.")
 
+        mb_limit = daily_mb_limit(u_data, user_tier(user_id))
+        if mb_limit and u_data.get("bytes_today", 0) >= mb_limit * 1024 * 1024 and user_id != ADMIN_ID:
+            return await update.message.reply_text(f"⚠️ سقف حجم دانلود روزانه شما ({mb_limit} مگابایت) تمام شده است.")
+
         if 'queue' not in context.chat_data:
             context.chat_data['queue'] = deque()
         context.chat_data['queue'].append(url)
@@ -286,135 +1247,57 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text(f"✅ لینک در صف قرار گرفت. (موقعیت: {len(context.chat_data['queue'])})")
 
+        # صف هر چت در یک task جدا اجرا می‌شود تا هندلر آپدیت‌ها (توقف، لغو، لینک‌های بعدی) مسدود نشود
         if not context.chat_data.get('is_working'):
-            await run_next(update.effective_chat.id, context)
+            context.chat_data['is_working'] = True
+            context.application.create_task(run_next(update.effective_chat.id, context))
 
 
 async def run_next(chat_id, context):
-    if not context.chat_data.get('queue'):
-        context.chat_data['is_working'] = False
+    chat_data = context.chat_data
+    if not chat_data.get('queue'):
+        chat_data['is_working'] = False
         return
 
-    context.chat_data['is_working'] = True
-    url = context.chat_data['queue'].popleft()
-    context.chat_data['status'] = 'downloading'
-    context.chat_data['current_url'] = url
+    chat_data['is_working'] = True
+    url = chat_data['queue'].popleft()
+    chat_data['current_url'] = url
 
-    filename = urllib.parse.unquote(url.split('/')[-1].split('?')[0]) or f"file_{int(time.time())}"
-    context.chat_data['current_filename'] = filename
+    filename = urllib.parse.unquote(url.split('/')[-1].split('?')[0].split('#')[0]) or f"file_{int(time.time())}"
+    chat_data['current_filename'] = filename
 
     msg = await context.bot.send_message(chat_id, "🔍 در حال بررسی لینک...")
-    context.chat_data['msg_id'] = msg.message_id
+    chat_data['msg_id'] = msg.message_id
 
-    res = await download_engine(chat_id, context, url, filename)
+    job = get_or_create_job(url, filename, context.bot)
+    sub = subscribe(job, chat_id, msg.message_id, chat_data.get('initiator_id', chat_id))
+    chat_data['job'] = job
+    chat_data['sub'] = sub
+
+    # job تازه وارد زمان‌بند می‌شود؛ job در صف با پیوستن کاربر پراولویت‌تر ارتقا می‌یابد.
+    # job مشترک قابل توقف نیست، پس job متوقف‌شده با پیوستن کاربر جدید ادامه پیدا می‌کند
+    if job["status"] in ("new", "queued"):
+        request_slot(job)
+    elif job["status"] == "paused":
+        resume_job(job)
+
+    if len(job["subscribers"]) > 1:
+        try:
+            await context.bot.edit_message_text("🔗 این لینک هم‌اکنون در حال دانلود است؛ فایل پس از اتمام برای شما هم ارسال می‌شود.", chat_id, msg.message_id)
+        except Exception:
+            pass
+
+    res = await sub["done"]
     await finalize_dl(chat_id, context, res)
 
 
 async def finalize_dl(chat_id, context, res):
     chat_data = context.chat_data
-    file_path = os.path.join(DOWNLOAD_DIR, chat_data.get('current_filename', ''))
+    sub = chat_data.get('sub', {})
 
     if res == "completed":
-        initiator = str(chat_data.get('initiator_id', chat_id))
-        # محافظت از اینکه اگر uid در db نیست، اضافه شود
-        if initiator not in db['users']:
-            db['users'][initiator] = {"downloads_today": 0, "last_reset": str(datetime.now().date()), "status": "active", "personal_limit": None}
-        db["users"][initiator]["downloads_today"] += 1
-        save_db(db)
-
-        await context.bot.edit_message_text("✅ دانلود تمام شد. در حال ارسال به تلگرام...", chat_id, chat_data['msg_id'])
-
-        if os.path.exists(file_path):
-            is_vid = chat_data['current_filename'].lower().endswith(VIDEO_EXTS)
-            file_size = os.path.getsize(file_path)
-
-            # --- شروع بخش برش نهایی و قطعی ---
-            if file_size > CHUNK_SIZE:
-                await context.bot.edit_message_text("✂️ در حال قطعه‌قطعه کردن ویدیو (این کار ممکن است کمی طول بکشد)...", chat_id, chat_data['msg_id'])
-
-                base_name, extension = os.path.splitext(chat_data['current_filename'])
-                if not extension:
-                    extension = ".mp4"
-                clean_name = "".join([c for c in base_name if c.isalnum()]).strip()
-
-                # ایجاد پوشه موقت
-                temp_parts_dir = os.path.join(DOWNLOAD_DIR, f"parts_{chat_id}_{int(time.time())}")
-                os.makedirs(temp_parts_dir, exist_ok=True)
-
-                try:
-                    output_template = os.path.join(temp_parts_dir, f"Part_%03d_{clean_name}{extension}")
-
-                    command = [
-                        'ffmpeg', '-y', '-i', file_path,
-                        '-force_key_frames', 'expr:gte(t,n_forced*60)',
-                        '-f', 'segment',
-                        '-segment_time', '00:07:00',
-                        '-reset_timestamps', '1',
-                        '-map', '0',
-                        '-c', 'copy',
-                        output_template
-                    ]
-
-                    # اجرای ffmpeg به صورت غیرمسدود
-                    await run_ffmpeg_async(command)
-
-                    generated_parts = sorted([f for f in os.listdir(temp_parts_dir) if f.startswith("Part_")])
-
-                    if not generated_parts:
-                        raise Exception("No parts created")
-
-                    total = len(generated_parts)
-                    for i, p_file in enumerate(generated_parts, 1):
-                        p_path = os.path.join(temp_parts_dir, p_file)
-                        if chat_data.get('status') == 'cancelled':
-                            break
-
-                        if os.path.getsize(p_path) > 48 * 1024 * 1024:
-                            logging.warning(f"Part too large even after segmentation: {p_path}")
-                            continue
-
-                        with open(p_path, 'rb') as tp:
-                            caption = f"🎬 **{chat_data['current_filename']}**\\n📦 پارت {i} از {total}"
-                            await context.bot.send_video(
-                                chat_id, video=tp, caption=caption,
-                                supports_streaming=True, parse_mode='Markdown',
-                                read_timeout=300, write_timeout=300
-                            )
-
-                        await safe_remove(p_path)
-                        await asyncio.sleep(2)
-
-                except Exception as e:
-                    logging.exception("Final Attempt Error")
-                    await context.bot.send_message(chat_id, "❌ متاسفانه به دلیل ساختار خاص این ویدیو، امکان برش هوشمند نبود.")
-
-                finally:
-                    def _rmdir(p):
-                        import shutil
-                        if os.path.exists(p):
-                            shutil.rmtree(p)
-                    await run_in_background(_rmdir, temp_parts_dir)
-            # --- پایان بخش برش ---
-
-            # --- شروع بخش ارسال تک فایل ---
-            else:
-                with open(file_path, 'rb') as f:
-                    if is_vid:
-                        await context.bot.send_video(
-                            chat_id, video=f,
-                            caption=chat_data['current_filename'],
-                            supports_streaming=True,
-                            read_timeout=120, write_timeout=120
-                        )
-                    else:
-                        await context.bot.send_document(
-                            chat_id, document=f,
-                            caption=chat_data['current_filename'],
-                            read_timeout=120, write_timeout=120
-                        )
-
-            # پاکسازی فایل اصلی پس از اتمام (یا لغو)
-            await safe_remove(file_path)
+        # شمارنده‌های کاربر، جمع روزانه و ایندکس مصرف با هم به‌روز می‌شوند
+        record_download(sub.get('user_id', chat_id), chat_data['job']["size"])
 
         try:
             await context.bot.delete_message(chat_id, chat_data['msg_id'])
@@ -430,17 +1313,16 @@ async def finalize_dl(chat_id, context, res):
         await run_next(chat_id, context)
 
     elif res == "cancelled":
-        if os.path.exists(file_path):
-            await safe_remove(file_path)
-        await context.bot.send_message(chat_id, "❌ دانلود لغو شد.")
+        # پیام لغو قبلاً توسط dl_cancel نمایش داده شده است
         await run_next(chat_id, context)
 
     else:
-        # خطا
+        # خطا (پیام سهمیه همان‌طور که هست نمایش داده می‌شود)
+        text = res if res.startswith("⚠️") else f"❌ خطا: {res}"
         try:
-            await context.bot.edit_message_text(f"❌ خطا: {res}", chat_id, chat_data.get('msg_id'))
+            await context.bot.edit_message_text(text, chat_id, chat_data.get('msg_id'))
         except Exception:
-            await context.bot.send_message(chat_id, f"❌ خطا: {res}")
+            await context.bot.send_message(chat_id, text)
         await run_next(chat_id, context)
 
 
@@ -448,25 +1330,36 @@ async def finalize_dl(chat_id, context, res):
 async def callback_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
-    chat_id = update.effective_chat.id
+    job = context.chat_data.get('job')
+    sub = context.chat_data.get('sub')
 
     # مدیریت دانلودها (همیشه پردازش شوند)
+    if data in ("dl_pause", "dl_resume", "dl_cancel") and (job is None or sub not in job["subscribers"]):
+        await query.answer("❌ دانلود فعالی وجود ندارد")
+        return
+
     if data == "dl_pause":
-        context.chat_data['status'] = 'paused'
+        if len(job["subscribers"]) > 1:
+            await query.answer("⚠️ این دانلود بین چند کاربر مشترک است و قابل توقف نیست.", show_alert=True)
+            return
+        if not pause_job(job):
+            await query.answer()
+            return
         await query.answer("متوقف شد")
+        kb = [[InlineKeyboardButton("▶️ ادامه", callback_data="dl_resume"),
+               InlineKeyboardButton("❌ لغو", callback_data="dl_cancel")]]
+        await query.edit_message_text("⏸ دانلود متوقف شد.", reply_markup=InlineKeyboardMarkup(kb))
         return
     elif data == "dl_resume":
-        context.chat_data['status'] = 'downloading'
+        # ادامه فقط رویداد job را set می‌کند؛ ضربه‌های تکراری task جدیدی نمی‌سازند
+        if not resume_job(job):
+            await query.answer()
+            return
         await query.answer("ادامه دانلود")
-        asyncio.create_task(download_engine_wrapper(chat_id, context))
         return
     elif data == "dl_cancel":
-        context.chat_data['status'] = 'cancelled'
-        file_path = os.path.join(DOWNLOAD_DIR, context.chat_data.get('current_filename', ''))
-        if os.path.exists(file_path):
-            await safe_remove(file_path)
+        unsubscribe(job, sub, "cancelled")
         await query.edit_message_text("❌ دانلود لغو شد.")
-        await run_next(chat_id, context)
         return
 
     # اگر callback مربوط به ادمین است، به رجیستری بسپار
@@ -483,11 +1376,6 @@ async def callback_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
 
-async def download_engine_wrapper(chat_id, context):
-    res = await download_engine(chat_id, context, context.chat_data['current_url'], context.chat_data['current_filename'])
-    await finalize_dl(chat_id, context, res)
-
-
 # --- ADMIN handlers (ثبت در رجیستری) ---
 @register_admin_callback("adm_clear_confirm")
 async def adm_clear_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -503,11 +1391,21 @@ async def adm_clear_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def adm_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.edit_message_text("⏳ در حال پاکسازی ...")
 
+    # پوشه‌های کاری دانلودهای در جریان دست نمی‌خورند
+    active = {job["id"] for job in ACTIVE_JOBS.values()}
+
     def clear_folder():
+        import shutil
         cnt = 0
         for f in os.listdir(DOWNLOAD_DIR):
+            if f in active:
+                continue
+            path = os.path.join(DOWNLOAD_DIR, f)
             try:
-                os.remove(os.path.join(DOWNLOAD_DIR, f))
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
                 cnt += 1
             except Exception:
                 pass
@@ -550,12 +1448,40 @@ async def adm_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @register_admin_callback("adm_history")
 async def adm_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    total_dl = sum(u['downloads_today'] for u in db['users'].values())
-    msg = f"📈 **آمار سیستم:**\\n\\nکل دانلودهای امروز: {total_dl}"
-    kb = [[InlineKeyboardButton("🔙 بازگشت", callback_data="adm_main")]]
+    current_period()
+    msg = (
+        f"📈 **آمار سیستم:**\\n\\nکل دانلودهای امروز: {STATS['downloads']}\\n"
+        f"حجم دانلود امروز: {human_readable_size(STATS['bytes'])}\\n"
+        f"کاربران فعال امروز: {len(USAGE_INDEX)} از {len(USER_INDEX)}\\n"
+        f"دانلودهای در جریان: {len(SCHEDULER['running'])}"
+    )
+    kb = [[InlineKeyboardButton("🏆 پرمصرف‌ترین کاربران", callback_data="adm_top")],
+          [InlineKeyboardButton(f"🗓 گزارش {HISTORY_REPORT_DAYS} روز اخیر", callback_data="adm_report")],
+          [InlineKeyboardButton("🔙 بازگشت", callback_data="adm_main")]]
     await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
 
+@register_admin_callback("adm_report")
+async def adm_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    per_day, per_user = await run_in_background(history_report, HISTORY_REPORT_DAYS)
+    lines = [f"🗓 گزارش {HISTORY_REPORT_DAYS} روز اخیر:\n"]
+    for day in sorted(per_day, reverse=True):
+        d = per_day[day]
+        speed = d["completed_bytes"] / d["duration"] if d["duration"] > 0 else 0
+        lines.append(f"{day}: {d['completed']}/{d['jobs']} موفق — {human_readable_size(d['bytes'])} — میانگین {human_readable_size(speed)}/s")
+    if not per_day:
+        lines.append("هنوز دانلودی در ژورنال ثبت نشده است.")
+
+    top_users = sorted(per_user.items(), key=lambda item: item[1]["bytes"], reverse=True)[:10]
+    if top_users:
+        lines.append("\n👥 بیشترین حجم به تفکیک کاربر:")
+        for uid, u in top_users:
+            lines.append(f"{uid}: {u['jobs']} دانلود — {human_readable_size(u['bytes'])}")
+
+    kb = [[InlineKeyboardButton("🔙 بازگشت", callback_data="adm_history")]]
+    await update.callback_query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
+
+
 @register_admin_callback("adm_main")
 async def adm_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await admin_menu(update, context)
@@ -563,31 +1489,73 @@ async def adm_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @register_admin_callback("adm_users")
 async def adm_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = update.callback_query.data  # e.g. "adm_users:0"
-    parts = data.split(':')
-    page = int(parts[1]) if len(parts) > 1 else 0
-
-    users = list(db['users'].items())
-    start = page * PAGE_SIZE
-    page_users = users[start:start + PAGE_SIZE]
+    # صفحه‌بندی keyset روی USER_INDEX:
+    #   adm_users:<after>    کاربران با شناسه بزرگ‌تر از after
+    #   adm_users:<before>:b صفحه قبل از کاربر before
+    parts = update.callback_query.data.split(':')
+    cursor = int(parts[1]) if len(parts) > 1 else 0
+    if len(parts) > 2 and parts[2] == "b":
+        end = bisect.bisect_left(USER_INDEX, cursor)
+        start = max(0, end - PAGE_SIZE)
+    else:
+        start = bisect.bisect_right(USER_INDEX, cursor)
+    page_uids = USER_INDEX[start:start + PAGE_SIZE]
+    # کلید بازگشت از پنل کاربر به همین صفحه
+    after = USER_INDEX[start - 1] if start > 0 else 0
 
     kb = []
-    for uid, info in page_users:
+    for uid in page_uids:
+        info = db['users'][str(uid)]
         status = info.get('status', 'active')
         personal = info.get('personal_limit') if info.get('personal_limit') is not None else '-'
         btn_text = f"{uid} ({status}) - limit: {personal}"
-        kb.append([InlineKeyboardButton(btn_text, callback_data=f"adm_user:{uid}:{page}")])
+        kb.append([InlineKeyboardButton(btn_text, callback_data=f"adm_user:{uid}:{after}")])
 
     nav = []
     if start > 0:
-        nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"adm_users:{page-1}"))
-    if start + PAGE_SIZE < len(users):
-        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"adm_users:{page+1}"))
+        nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"adm_users:{page_uids[0]}:b"))
+    if start + PAGE_SIZE < len(USER_INDEX):
+        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"adm_users:{page_uids[-1]}"))
     if nav:
         kb.append(nav)
+    kb.append([InlineKeyboardButton("🔍 جستجوی کاربر", callback_data="adm_search"), InlineKeyboardButton("🏆 مرتب بر اساس مصرف", callback_data="adm_top")])
     kb.append([InlineKeyboardButton("🔙 بازگشت", callback_data="adm_main")])
 
-    await update.callback_query.edit_message_text("👥 مدیریت کاربران:", reply_markup=InlineKeyboardMarkup(kb))
+    await update.callback_query.edit_message_text(f"👥 مدیریت کاربران ({len(USER_INDEX)} کاربر):", reply_markup=InlineKeyboardMarkup(kb))
+
+
+@register_admin_callback("adm_top")
+async def adm_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # صفحه‌بندی keyset روی USAGE_INDEX: adm_top:<count>:<uid> آخرین ردیف صفحه قبل
+    parts = update.callback_query.data.split(':')
+    current_period()
+    start = bisect.bisect_right(USAGE_INDEX, (-int(parts[1]), int(parts[2]))) if len(parts) > 2 else 0
+    rows = USAGE_INDEX[start:start + PAGE_SIZE]
+
+    kb = []
+    for rank, (neg_count, uid) in enumerate(rows, start + 1):
+        _, used = user_counters(db['users'][str(uid)])
+        kb.append([InlineKeyboardButton(f"{rank}. {uid} — {-neg_count} فایل / {human_readable_size(used)}", callback_data=f"adm_user:{uid}:0")])
+
+    nav = []
+    if start > 0:
+        nav.append(InlineKeyboardButton("⏮ ابتدا", callback_data="adm_top"))
+    if start + PAGE_SIZE < len(USAGE_INDEX):
+        neg_count, uid = rows[-1]
+        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"adm_top:{-neg_count}:{uid}"))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("🔙 بازگشت", callback_data="adm_users:0")])
+
+    title = "🏆 پرمصرف‌ترین کاربران امروز:" if rows else "🏆 امروز هنوز دانلودی ثبت نشده است."
+    await update.callback_query.edit_message_text(title, reply_markup=InlineKeyboardMarkup(kb))
+
+
+@register_admin_callback("adm_search")
+async def adm_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['waiting_for_user_search'] = True
+    await update.callback_query.edit_message_text("لطفاً شناسه عددی کاربر را ارسال کنید:",
+                                                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ انصراف", callback_data="adm_users:0")]]))
 
 
 @register_admin_callback("adm_user")
@@ -596,14 +1564,33 @@ async def adm_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = update.callback_query.data.split(':')
     uid = parts[1]
     page = int(parts[2]) if len(parts) > 2 else 0
+    await show_user_panel(update, uid, page)
+
+
+def user_panel(uid, page):
+    # page همان کلید keyset صفحه لیست کاربران است (برای دکمه بازگشت)
     info = db['users'].get(uid, {})
-    msg = f"👤 کاربر: {uid}\\nوضعیت: {info.get('status','active')}\\nدانلود‌های امروز: {info.get('downloads_today',0)}\\nمحدودیت شخصی: {info.get('personal_limit', '-') }"
+    tier = user_tier(uid)
+    mb_limit = daily_mb_limit(info, tier)
+    downloads, used = user_counters(info)
+    msg = (
+        f"👤 کاربر: {uid}\\nوضعیت: {info.get('status','active')}\\nسطح: {tier}\\n"
+        f"دانلود‌های امروز: {downloads}\\nحجم امروز: {human_readable_size(used)}\\n"
+        f"محدودیت شخصی: {info.get('personal_limit', '-') }\\nسقف حجم روزانه: {f'{mb_limit} MB' if mb_limit else 'نامحدود'}"
+    )
     kb = [
         [InlineKeyboardButton("⛔️ بلاک", callback_data=f"adm_ban:{uid}:{page}"), InlineKeyboardButton("✅ آنبلاک", callback_data=f"adm_unban:{uid}:{page}")],
+        [InlineKeyboardButton("⭐️ پریمیوم", callback_data=f"adm_tier:{uid}:premium:{page}"), InlineKeyboardButton("👤 عادی", callback_data=f"adm_tier:{uid}:free:{page}")],
         [InlineKeyboardButton("🔢 تنظیم محدودیت کاربر", callback_data=f"adm_set_user_limit:{uid}:{page}" )],
+        [InlineKeyboardButton("📦 تنظیم سقف حجم کاربر", callback_data=f"adm_set_user_mb:{uid}:{page}")],
         [InlineKeyboardButton("🔙 بازگشت", callback_data=f"adm_users:{page}")]
     ]
-    await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+    return msg, InlineKeyboardMarkup(kb)
+
+
+async def show_user_panel(update, uid, page):
+    msg, markup = user_panel(uid, page)
+    await update.callback_query.edit_message_text(msg, reply_markup=markup)
 
 
 @register_admin_callback("adm_ban")
@@ -615,7 +1602,7 @@ async def adm_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db['users'][uid]['status'] = 'banned'
         save_db(db)
     await update.callback_query.answer("کاربر مسدود شد")
-    await adm_users(update, context)
+    await show_user_panel(update, uid, page)
 
 
 @register_admin_callback("adm_unban")
@@ -627,7 +1614,7 @@ async def adm_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db['users'][uid]['status'] = 'active'
         save_db(db)
     await update.callback_query.answer("کاربر آزاد شد")
-    await adm_users(update, context)
+    await show_user_panel(update, uid, page)
 
 
 @register_admin_callback("adm_set_user_limit")
@@ -639,11 +1626,42 @@ async def adm_set_user_limit(update: Update, context: ContextTypes.DEFAULT_TYPE)
                                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ انصراف", callback_data=f"adm_user:{uid}:0")]]))
 
 
+@register_admin_callback("adm_tier")
+async def adm_tier(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # data pattern: adm_tier:<uid>:<tier>:<page>
+    parts = update.callback_query.data.split(':')
+    uid, tier = parts[1], parts[2]
+    page = parts[3] if len(parts) > 3 else "0"
+    if tier in TIERS and tier != "admin":
+        ensure_user(uid)['tier'] = tier
+        save_db(db)
+    await update.callback_query.answer(f"سطح کاربر: {tier}")
+    await show_user_panel(update, uid, int(page))
+
+
+@register_admin_callback("adm_set_user_mb")
+async def adm_set_user_mb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.callback_query.data.split(':')
+    uid = parts[1]
+    context.user_data['setting_user_mb_for'] = uid
+    await update.callback_query.edit_message_text(f"لطفاً سقف حجم دانلود روزانه کاربر {uid} را به مگابایت ارسال کنید (0 = نامحدود):",
+                                                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ انصراف", callback_data=f"adm_user:{uid}:0")]]))
+
+
 @register_admin_callback("adm_settings")
 async def adm_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = f"⚙️ تنظیمات سیستم:\n\nمحدودیت کلی فعلی: {db['settings'].get('daily_limit')}"
+    settings = db['settings']
+    tier_mb = settings['tier_daily_mb']
+    msg = (
+        f"⚙️ تنظیمات سیستم:\n\nمحدودیت کلی فعلی: {settings.get('daily_limit')}\n"
+        f"ظرفیت دانلود همزمان: {settings['max_concurrent']} (فعال: {len(SCHEDULER['running'])})\n"
+        f"سقف حجم روزانه پریمیوم: {tier_mb.get('premium') or 'نامحدود'} MB\n"
+        f"سقف حجم روزانه عادی: {tier_mb.get('free') or 'نامحدود'} MB"
+    )
     kb = [
         [InlineKeyboardButton("🔢 تغییر محدودیت کلی", callback_data="adm_set_limit")],
+        [InlineKeyboardButton("🔀 تغییر ظرفیت همزمان", callback_data="adm_set_concurrency")],
+        [InlineKeyboardButton("📦 سقف حجم پریمیوم", callback_data="adm_set_tier_mb:premium"), InlineKeyboardButton("📦 سقف حجم عادی", callback_data="adm_set_tier_mb:free")],
         [InlineKeyboardButton("🔙 بازگشت", callback_data="adm_main")]
     ]
     await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
@@ -656,30 +1674,56 @@ async def adm_set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ انصراف", callback_data="adm_settings")]]))
 
 
+@register_admin_callback("adm_set_concurrency")
+async def adm_set_concurrency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['waiting_for_concurrency'] = True
+    await update.callback_query.edit_message_text("لطفاً تعداد دانلودهای همزمان مجاز را ارسال کنید:",
+                                                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ انصراف", callback_data="adm_settings")]]))
+
+
+@register_admin_callback("adm_set_tier_mb")
+async def adm_set_tier_mb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tier = update.callback_query.data.split(':')[1]
+    context.user_data['setting_tier_mb_for'] = tier
+    await update.callback_query.edit_message_text(f"لطفاً سقف حجم دانلود روزانه سطح {tier} را به مگابایت ارسال کنید (0 = نامحدود):",
+                                                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ انصراف", callback_data="adm_settings")]]))
+
+
 @register_admin_callback("adm_files")
 async def adm_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    files = os.listdir(DOWNLOAD_DIR)
-    total_size = sum(os.path.getsize(os.path.join(DOWNLOAD_DIR, f)) for f in files)
-    msg = f"📂 فایل‌های دانلود شده: {len(files)}\\nحجم کل: {human_readable_size(total_size)}"
+    # پیمایش دیسک در thread جدا انجام می‌شود تا حلقه رویداد ربات مسدود نشود
+    def scan_folder():
+        count, size = 0, 0
+        for root, _, names in os.walk(DOWNLOAD_DIR):
+            for f in names:
+                try:
+                    size += os.path.getsize(os.path.join(root, f))
+                    count += 1
+                except OSError:
+                    pass
+        return count, size
+
+    count, total_size = await run_in_background(scan_folder)
+    msg = f"📂 فایل‌های دانلود شده: {count}\\nحجم کل: {human_readable_size(total_size)}"
     kb = [[InlineKeyboardButton("🧹 پاکسازی", callback_data="adm_clear_confirm")], [InlineKeyboardButton("🔙 بازگشت", callback_data="adm_main")]]
     await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
 
 
 @register_admin_callback("adm_active")
 async def adm_active(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # نمایش وضعیت پوشه دانلود و محتویات صف چت ادمین (اگر وجود داشته باشد)
-    files = os.listdir(DOWNLOAD_DIR)
-    pending = len(files)
-    msg = f"📥 در حال دانلود / صف: {pending} فایل در پوشه دانلود (این عدد شامل فایل‌های کامل و پارت‌ها می‌شود)."
+    # نمایش تعداد دانلودهای در جریان از رجیستری job ها
+    pending = len(ACTIVE_JOBS)
+    msg = f"📥 در حال دانلود / صف: {pending} دانلود فعال (هر دانلود مشترک یک بار شمرده می‌شود)."
     kb = [[InlineKeyboardButton("🔙 بازگشت", callback_data="adm_main")]]
     await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
 
 
 @register_admin_callback("adm_reset_stats")
 async def adm_reset_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    for uid in db['users']:
-        db['users'][uid]['downloads_today'] = 0
-        db['users'][uid]['last_reset'] = str(datetime.now().date())
+    # بازنشانی lazy: با تغییر epoch، شمارنده همه کاربران بدون بازنویسی تک‌تک آن‌ها منقضی می‌شود
+    db['settings']['stats_epoch'] = db['settings'].get('stats_epoch', 0) + 1
+    STATS.update(downloads=0, bytes=0)
+    USAGE_INDEX.clear()
     save_db(db)
     await update.callback_query.answer("آمار کاربران بازنشانی شد")
     await adm_main(update, context)
@@ -700,16 +1744,90 @@ async def global_error_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         pass
 
 
-# --- اجرای اصلی ---
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO, filename=LOG_FILE, format='%(asctime)s - %(levelname)s - %(message)s')
-
-    app = Application.builder().token(TOKEN).build()
+# --- راه‌اندازی سریع ---
+def remove_stale_workspaces():
+    # پوشه کاری job هایی که با crash یا ری‌استارت رها شده‌اند؛ job در حافظه آن‌ها دیگر وجود ندارد.
+    # هنگام ری‌استارت تدریجی، پروسه قبلی ممکن است هنوز در پوشه‌های خودش بنویسد؛ پس فقط پوشه‌هایی
+    # حذف می‌شوند که خودشان و فایل‌هایشان مدتی طولانی تغییر نکرده‌اند
+    import shutil
+    active = {job["id"] for job in list(ACTIVE_JOBS.values())}
+    cutoff = time.time() - WORKSPACE_STALE_AGE
+    for name in os.listdir(DOWNLOAD_DIR):
+        path = os.path.join(DOWNLOAD_DIR, name)
+        if name in active or not os.path.isdir(path):
+            continue
+        try:
+            with os.scandir(path) as entries:
+                newest = max([os.path.getmtime(path)] + [e.stat().st_mtime for e in entries])
+        except OSError:
+            continue
+        if newest < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_data():
+    # خواندن JSON ها و ساخت ایندکس‌ها؛ در thread جدا و همزمان با اتصال اولیه به تلگرام اجرا می‌شود
+    global db, file_cache, host_profiles
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    db = load_db()
+    build_indexes()
+    file_cache = load_file_cache()
+    host_profiles = load_host_profiles()
+    mark_phase("data")
+
+
+def build_application(data_future=None):
+    async def on_startup(app):
+        # هیچ آپدیتی قبل از آماده شدن داده‌ها پردازش نمی‌شود
+        if data_future is not None:
+            await asyncio.wrap_future(data_future)
+        mark_phase("ready")
+        logging.info(f"Startup phases: {startup_report()}")
+
+    async def on_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not any(name == "first_update" for name, _ in STARTUP_PHASES):
+            mark_phase("first_update")
+            logging.info(f"Startup phases: {startup_report()}")
+
+    app = Application.builder().token(TOKEN).post_init(on_startup).build()
+    app.add_handler(TypeHandler(Update, on_first_update), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_menu))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_msg))
     app.add_handler(CallbackQueryHandler(callback_gate))
     app.add_error_handler(global_error_handler)
+    mark_phase("app_built")
+    return app
+
+
+# --- اجرای اصلی ---
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+
+    if "--startup-bench" in sys.argv:
+        # بنچمارک راه‌اندازی بدون اتصال به تلگرام: همان مسیر اجرای واقعی (بارگذاری داده در thread،
+        # ساخت Application و post_init)، سپس یک Update ساختگی از handler ها عبور می‌کند تا فاز
+        # first_update هم اندازه‌گیری شود. زمان handshake شبکه در این اعداد نیست.
+        async def replay_first_update(app):
+            await app.post_init(app)
+            await app.process_update(Update(update_id=0))
+
+        with ThreadPoolExecutor(max_workers=1) as bench_executor:
+            bench_app = build_application(bench_executor.submit(load_data))
+            asyncio.run(replay_first_update(bench_app))
+        print(f"⏱ {startup_report()}")
+        sys.exit(0)
+
+    log_listener = setup_logging()
+
+    data_executor = ThreadPoolExecutor(max_workers=1)
+    app = build_application(data_executor.submit(load_data))
+    # پاکسازی پوشه‌های رهاشده فقط در اجرای واقعی و پس از load_data، بدون معطل کردن راه‌اندازی
+    data_executor.submit(remove_stale_workspaces)
 
     print("🤖 Bot Started...")
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        data_executor.shutdown(wait=False)
+        log_listener.stop()